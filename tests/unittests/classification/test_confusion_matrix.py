@@ -11,13 +11,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from functools import partial
+from functools import lru_cache, partial
+from itertools import product
 
 import numpy as np
 import pytest
 import torch
-from scipy.special import expit as sigmoid
-from sklearn.metrics import confusion_matrix as sk_confusion_matrix
 from torchmetrics.classification.confusion_matrix import (
     BinaryConfusionMatrix,
     ConfusionMatrix,
@@ -33,42 +32,140 @@ from torchmetrics.metric import Metric
 
 from unittests import NUM_CLASSES, THRESHOLD
 from unittests._helpers import seed_all
-from unittests._helpers.testers import MetricTester, inject_ignore_index, remove_ignore_index
+from unittests._helpers.testers import MetricTester, inject_ignore_index
 from unittests.classification._inputs import _binary_cases, _multiclass_cases, _multilabel_cases
 
 seed_all(42)
 
+_LOGIT_THRESHOLD = float(np.log(THRESHOLD / (1.0 - THRESHOLD)))
 
-def _reference_sklearn_confusion_matrix_binary(preds, target, normalize=None, ignore_index=None):
-    preds = preds.view(-1).numpy()
-    target = target.view(-1).numpy()
+# Latin-square subset of the (normalize, ignore_index, ddp) grid that covers every level of each axis at least once,
+# these cells always run while the rest of the grid is marked as `slow` and only runs in the full (nightly) suite
+_SMOKE_SET = {("true", None, False), ("pred", -1, True), ("all", 0, False), (None, None, True)}
+
+
+def _grid_param(normalize, ignore_index, ddp=None):
+    """Parametrize one cell of the test grid, cells outside of ``_SMOKE_SET`` are marked as ``slow``."""
+    smoke = any(cell[:2] == (normalize, ignore_index) and ddp in (None, cell[2]) for cell in _SMOKE_SET)
+    marks = [pytest.mark.DDP] if ddp else []
+    if not smoke:
+        marks.append(pytest.mark.slow)
+    values = (normalize, ignore_index) if ddp is None else (normalize, ignore_index, ddp)
+    return pytest.param(*values, marks=marks)
+
+
+_CLASS_TEST_GRID = [
+    _grid_param(normalize, ignore_index, ddp)
+    for normalize, ignore_index, ddp in product(["true", "pred", "all", None], [None, -1, 0], [True, False])
+]
+_FUNCTIONAL_TEST_GRID = [
+    _grid_param(normalize, ignore_index)
+    for normalize, ignore_index in product(["true", "pred", "all", None], [None, -1, 0])
+]
+
+
+def _to_numpy(tensor):
+    """Convert to numpy, sharing memory with ``tensor`` whenever it is already a contiguous cpu tensor."""
+    tensor = tensor.detach()
+    if tensor.is_contiguous() and tensor.device.type == "cpu":
+        return tensor.numpy()
+    return tensor.contiguous().cpu().numpy()
+
+
+def _is_logits(preds, sample_size=64):
+    """Check if ``preds`` falls outside of ``[0, 1]`` with two reductions instead of two boolean temporaries.
+
+    Logits almost always leave the range within the first few elements, so a small leading sample is checked first and
+    the full reductions only run when the sample is inconclusive. The result is exact either way.
+
+    """
+    sample = preds.ravel()[:sample_size]
+    if sample.min() < 0.0 or sample.max() > 1.0:
+        return True
+    return bool(preds.min() < 0.0 or preds.max() > 1.0)
+
+
+@lru_cache(maxsize=None)
+def _inject_ignore_index(target, ignore_index):
+    """Inject ``ignore_index`` once per input case instead of once per parametrization.
+
+    Tensors hash by identity and the cache keeps them alive, so the module level input cases are safe keys.
+
+    """
+    return inject_ignore_index(target, ignore_index)
+
+
+def _masked_bincount(idx, target, ignore_index, minlength):
+    """Bincount of the flat ``idx`` skipping entries whose ``target`` equals ``ignore_index``.
+
+    Only the encoded index is gathered, instead of copying both ``target`` and ``preds`` with ``remove_ignore_index``.
+
+    """
+    if ignore_index is not None:
+        idx = idx[target.ravel() != ignore_index]
+    return np.bincount(idx, minlength=minlength)
+
+
+def _confusion_matrix_counts(target, preds, num_classes, ignore_index=None, multilabel=False):
+    """Unnormalized confusion matrix shared by all three references.
+
+    Flat ``target`` and ``preds`` give a single ``num_classes x num_classes`` matrix. With ``multilabel=True`` the
+    inputs are ``(N, num_labels, ...)`` and one matrix is counted per label, resulting in ``num_labels x 2 x 2``.
+
+    """
+    # single pass over the data instead of sklearn's sparse matrix construction
+    idx = target.astype(np.int64) * num_classes + preds.astype(np.int64)
+    if not multilabel:
+        return _masked_bincount(idx, target, ignore_index, num_classes**2).reshape(num_classes, num_classes)
+    num_labels = target.shape[1]
+    # the label of each element is its coordinate along dim 1, so it is broadcast in place instead of moving that
+    # axis to the end, which would force a copy of both inputs; all labels are then counted in a single bincount
+    idx += num_classes**2 * np.arange(num_labels).reshape(1, num_labels, *(1,) * (target.ndim - 2))
+    confmat = _masked_bincount(idx.ravel(), target, ignore_index, num_labels * num_classes**2)
+    return confmat.reshape(num_labels, num_classes, num_classes)
+
+
+def _normalize_confusion_matrix(confmat, normalize=None):
+    """Normalize the last two dimensions of ``confmat`` the same way as sklearn, mapping ``0 / 0`` to zero."""
+    if normalize is None:
+        return confmat
+    if normalize == "true":
+        denom = confmat.sum(axis=-1, keepdims=True)
+    elif normalize == "pred":
+        denom = confmat.sum(axis=-2, keepdims=True)
+    else:
+        denom = confmat.sum(axis=(-2, -1), keepdims=True)
+    return np.divide(confmat, denom, out=np.zeros(confmat.shape, dtype=np.float64), where=denom != 0)
+
+
+def _reference_confusion_matrix_binary(preds, target, normalize=None, ignore_index=None):
+    preds = _to_numpy(preds).reshape(-1)
+    target = _to_numpy(target).reshape(-1)
     if np.issubdtype(preds.dtype, np.floating):
-        if not ((preds > 0) & (preds < 1)).all():
-            preds = sigmoid(preds)
-        preds = (preds >= THRESHOLD).astype(np.uint8)
-    target, preds = remove_ignore_index(target, preds, ignore_index)
-    return sk_confusion_matrix(y_true=target, y_pred=preds, labels=[0, 1], normalize=normalize)
+        # sigmoid(x) >= t is equivalent to x >= logit(t), so logits are thresholded without applying the sigmoid
+        threshold = _LOGIT_THRESHOLD if _is_logits(preds) else THRESHOLD
+        preds = (preds >= threshold).view(np.uint8)
+    confmat = _confusion_matrix_counts(target, preds, 2, ignore_index)
+    return _normalize_confusion_matrix(confmat, normalize)
 
 
 @pytest.mark.parametrize("inputs", _binary_cases)
 class TestBinaryConfusionMatrix(MetricTester):
     """Test class for `BinaryConfusionMatrix` metric."""
 
-    @pytest.mark.parametrize("normalize", ["true", "pred", "all", None])
-    @pytest.mark.parametrize("ignore_index", [None, -1, 0])
-    @pytest.mark.parametrize("ddp", [pytest.param(True, marks=pytest.mark.DDP), False])
+    @pytest.mark.parametrize(("normalize", "ignore_index", "ddp"), _CLASS_TEST_GRID)
     def test_binary_confusion_matrix(self, inputs, ddp, normalize, ignore_index):
         """Test class implementation of metric."""
         preds, target = inputs
         if ignore_index is not None:
-            target = inject_ignore_index(target, ignore_index)
+            target = _inject_ignore_index(target, ignore_index)
         self.run_class_metric_test(
             ddp=ddp,
             preds=preds,
             target=target,
             metric_class=BinaryConfusionMatrix,
             reference_metric=partial(
-                _reference_sklearn_confusion_matrix_binary, normalize=normalize, ignore_index=ignore_index
+                _reference_confusion_matrix_binary, normalize=normalize, ignore_index=ignore_index
             ),
             metric_args={
                 "threshold": THRESHOLD,
@@ -77,19 +174,18 @@ class TestBinaryConfusionMatrix(MetricTester):
             },
         )
 
-    @pytest.mark.parametrize("normalize", ["true", "pred", "all", None])
-    @pytest.mark.parametrize("ignore_index", [None, -1, 0])
+    @pytest.mark.parametrize(("normalize", "ignore_index"), _FUNCTIONAL_TEST_GRID)
     def test_binary_confusion_matrix_functional(self, inputs, normalize, ignore_index):
         """Test functional implementation of metric."""
         preds, target = inputs
         if ignore_index is not None:
-            target = inject_ignore_index(target, ignore_index)
+            target = _inject_ignore_index(target, ignore_index)
         self.run_functional_metric_test(
             preds=preds,
             target=target,
             metric_functional=binary_confusion_matrix,
             reference_metric=partial(
-                _reference_sklearn_confusion_matrix_binary, normalize=normalize, ignore_index=ignore_index
+                _reference_confusion_matrix_binary, normalize=normalize, ignore_index=ignore_index
             ),
             metric_args={
                 "threshold": THRESHOLD,
@@ -140,36 +236,34 @@ class TestBinaryConfusionMatrix(MetricTester):
         )
 
 
-def _reference_sklearn_confusion_matrix_multiclass(preds, target, normalize=None, ignore_index=None):
-    preds = preds.numpy()
-    target = target.numpy()
+def _reference_confusion_matrix_multiclass(preds, target, normalize=None, ignore_index=None):
+    preds = _to_numpy(preds)
+    target = _to_numpy(target)
     if np.issubdtype(preds.dtype, np.floating):
         preds = np.argmax(preds, axis=1)
     preds = preds.flatten()
     target = target.flatten()
-    target, preds = remove_ignore_index(target, preds, ignore_index)
-    return sk_confusion_matrix(y_true=target, y_pred=preds, normalize=normalize, labels=list(range(NUM_CLASSES)))
+    confmat = _confusion_matrix_counts(target, preds, NUM_CLASSES, ignore_index)
+    return _normalize_confusion_matrix(confmat, normalize)
 
 
 @pytest.mark.parametrize("inputs", _multiclass_cases)
 class TestMulticlassConfusionMatrix(MetricTester):
     """Test class for `MultiClassConfusionMatrix` metric."""
 
-    @pytest.mark.parametrize("normalize", ["true", "pred", "all", None])
-    @pytest.mark.parametrize("ignore_index", [None, -1, 0])
-    @pytest.mark.parametrize("ddp", [pytest.param(True, marks=pytest.mark.DDP), False])
+    @pytest.mark.parametrize(("normalize", "ignore_index", "ddp"), _CLASS_TEST_GRID)
     def test_multiclass_confusion_matrix(self, inputs, ddp, normalize, ignore_index):
         """Test class implementation of metric."""
         preds, target = inputs
         if ignore_index is not None:
-            target = inject_ignore_index(target, ignore_index)
+            target = _inject_ignore_index(target, ignore_index)
         self.run_class_metric_test(
             ddp=ddp,
             preds=preds,
             target=target,
             metric_class=MulticlassConfusionMatrix,
             reference_metric=partial(
-                _reference_sklearn_confusion_matrix_multiclass, normalize=normalize, ignore_index=ignore_index
+                _reference_confusion_matrix_multiclass, normalize=normalize, ignore_index=ignore_index
             ),
             metric_args={
                 "num_classes": NUM_CLASSES,
@@ -178,19 +272,18 @@ class TestMulticlassConfusionMatrix(MetricTester):
             },
         )
 
-    @pytest.mark.parametrize("normalize", ["true", "pred", "all", None])
-    @pytest.mark.parametrize("ignore_index", [None, -1, 0])
+    @pytest.mark.parametrize(("normalize", "ignore_index"), _FUNCTIONAL_TEST_GRID)
     def test_multiclass_confusion_matrix_functional(self, inputs, normalize, ignore_index):
         """Test functional implementation of metric."""
         preds, target = inputs
         if ignore_index is not None:
-            target = inject_ignore_index(target, ignore_index)
+            target = _inject_ignore_index(target, ignore_index)
         self.run_functional_metric_test(
             preds=preds,
             target=target,
             metric_functional=multiclass_confusion_matrix,
             reference_metric=partial(
-                _reference_sklearn_confusion_matrix_multiclass, normalize=normalize, ignore_index=ignore_index
+                _reference_confusion_matrix_multiclass, normalize=normalize, ignore_index=ignore_index
             ),
             metric_args={
                 "num_classes": NUM_CLASSES,
@@ -282,46 +375,38 @@ def test_multiclass_overflow():
     m = MulticlassConfusionMatrix(num_classes=20)
     res = m(preds, target)
 
-    compare = sk_confusion_matrix(target, preds)
-    assert torch.allclose(res, torch.tensor(compare))
+    compare = torch.bincount(target.long() * 20 + preds.long(), minlength=20 * 20).reshape(20, 20)
+    assert torch.allclose(res, compare)
 
 
-def _reference_sklearn_confusion_matrix_multilabel(preds, target, normalize=None, ignore_index=None):
-    preds = preds.numpy()
-    target = target.numpy()
+def _reference_confusion_matrix_multilabel(preds, target, normalize=None, ignore_index=None):
+    preds = _to_numpy(preds)
+    target = _to_numpy(target)
     if np.issubdtype(preds.dtype, np.floating):
-        if not ((preds > 0) & (preds < 1)).all():
-            preds = sigmoid(preds)
-        preds = (preds >= THRESHOLD).astype(np.uint8)
-    preds = np.moveaxis(preds, 1, -1).reshape((-1, preds.shape[1]))
-    target = np.moveaxis(target, 1, -1).reshape((-1, target.shape[1]))
-    confmat = []
-    for i in range(preds.shape[1]):
-        pred, true = preds[:, i], target[:, i]
-        true, pred = remove_ignore_index(true, pred, ignore_index)
-        confmat.append(sk_confusion_matrix(true, pred, normalize=normalize, labels=[0, 1]))
-    return np.stack(confmat, axis=0)
+        # sigmoid(x) >= t is equivalent to x >= logit(t), so logits are thresholded without applying the sigmoid
+        threshold = _LOGIT_THRESHOLD if _is_logits(preds) else THRESHOLD
+        preds = (preds >= threshold).view(np.uint8)
+    confmat = _confusion_matrix_counts(target, preds, 2, ignore_index, multilabel=True)
+    return _normalize_confusion_matrix(confmat, normalize)
 
 
 @pytest.mark.parametrize("inputs", _multilabel_cases)
 class TestMultilabelConfusionMatrix(MetricTester):
     """Test class for `MultilabelConfusionMatrix` metric."""
 
-    @pytest.mark.parametrize("normalize", ["true", "pred", "all", None])
-    @pytest.mark.parametrize("ignore_index", [None, -1, 0])
-    @pytest.mark.parametrize("ddp", [pytest.param(True, marks=pytest.mark.DDP), False])
+    @pytest.mark.parametrize(("normalize", "ignore_index", "ddp"), _CLASS_TEST_GRID)
     def test_multilabel_confusion_matrix(self, inputs, ddp, normalize, ignore_index):
         """Test class implementation of metric."""
         preds, target = inputs
         if ignore_index is not None:
-            target = inject_ignore_index(target, ignore_index)
+            target = _inject_ignore_index(target, ignore_index)
         self.run_class_metric_test(
             ddp=ddp,
             preds=preds,
             target=target,
             metric_class=MultilabelConfusionMatrix,
             reference_metric=partial(
-                _reference_sklearn_confusion_matrix_multilabel, normalize=normalize, ignore_index=ignore_index
+                _reference_confusion_matrix_multilabel, normalize=normalize, ignore_index=ignore_index
             ),
             metric_args={
                 "num_labels": NUM_CLASSES,
@@ -330,19 +415,18 @@ class TestMultilabelConfusionMatrix(MetricTester):
             },
         )
 
-    @pytest.mark.parametrize("normalize", ["true", "pred", "all", None])
-    @pytest.mark.parametrize("ignore_index", [None, -1, 0])
+    @pytest.mark.parametrize(("normalize", "ignore_index"), _FUNCTIONAL_TEST_GRID)
     def test_multilabel_confusion_matrix_functional(self, inputs, normalize, ignore_index):
         """Test functional implementation of metric."""
         preds, target = inputs
         if ignore_index is not None:
-            target = inject_ignore_index(target, ignore_index)
+            target = _inject_ignore_index(target, ignore_index)
         self.run_functional_metric_test(
             preds=preds,
             target=target,
             metric_functional=multilabel_confusion_matrix,
             reference_metric=partial(
-                _reference_sklearn_confusion_matrix_multilabel, normalize=normalize, ignore_index=ignore_index
+                _reference_confusion_matrix_multilabel, normalize=normalize, ignore_index=ignore_index
             ),
             metric_args={
                 "num_labels": NUM_CLASSES,